@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+"""Builds a generated API reference with the sentry builders and reports
+how long reading and writing it took.
+
+Run this before and after touching the API directives to see whether a
+change makes a difference on a reference with many endpoints.
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+CONF = '''\
+import sys
+sys.path.insert(0, %r)
+project = 'API Benchmark'
+master_doc = 'index'
+import sentryext
+sentryext.activate()
+'''
+
+PATHS = [
+    '/api/0/projects/{organization_slug}/{project_slug}/',
+    '/api/0/projects/{organization_slug}/{project_slug}/events/',
+    '/api/0/projects/{organization_slug}/{project_slug}/events/{event_id}/',
+    '/api/0/projects/{organization_slug}/{project_slug}/releases/',
+    '/api/0/organizations/{organization_slug}/',
+    '/api/0/organizations/{organization_slug}/projects/',
+    '/api/0/issues/{issue_id}/',
+    '/api/0/issues/{issue_id}/events/latest/',
+]
+
+
+def write_endpoint(f, idx, description_lines):
+    path = PATHS[idx % len(PATHS)]
+    f.write('.. sentry:api-endpoint:: Endpoint %d\n\n' % idx)
+    for lineno in xrange(description_lines):
+        f.write('   Line %d of the description of endpoint %d with some '
+                'more text to read.\n' % (lineno, idx))
+    f.write('\n')
+    f.write('   :pparam string organization_slug: the slug of the '
+            'organization.\n')
+    f.write('   :pparam string project_slug: the slug of the project.\n')
+    f.write('   :qparam string cursor: the pagination cursor.\n')
+    f.write('   :http-method: %s\n' % ('GET', 'POST', 'PUT')[idx % 3])
+    f.write('   :http-path: %s\n' % path)
+    f.write('   :auth: required\n\n')
+
+
+def generate(srcdir, pages, endpoints, description_lines):
+    with open(os.path.join(srcdir, 'conf.py'), 'w') as f:
+        f.write(CONF % HERE)
+    with open(os.path.join(srcdir, 'index.rst'), 'w') as f:
+        f.write('API\n===\n\n.. toctree::\n\n')
+        for page in xrange(pages):
+            f.write('   api%d\n' % page)
+    for page in xrange(pages):
+        with open(os.path.join(srcdir, 'api%d.rst' % page), 'w') as f:
+            title = 'API %d' % page
+            f.write('%s\n%s\n\n' % (title, '=' * len(title)))
+            for idx in xrange(endpoints):
+                write_endpoint(f, page * endpoints + idx, description_lines)
+
+
+def run(srcdir, buildername):
+    from sphinx.application import Sphinx
+
+    outdir = os.path.join(srcdir, '_build', buildername)
+    doctreedir = os.path.join(srcdir, '_build', 'doctrees')
+    shutil.rmtree(os.path.join(srcdir, '_build'), ignore_errors=True)
+
+    app = Sphinx(srcdir, srcdir, outdir, doctreedir, buildername,
+                 {}, status=None)
+    marks = {}
+
+    def mark(name):
+        def listener(*args):
+            marks[name] = time.time()
+        return listener
+
+    # reading ends with env-updated, everything after that is writing
+    app.connect('env-before-read-docs', mark('read'))
+    app.connect('env-updated', mark('write'))
+    app.connect('build-finished', mark('end'))
+    app.build(True)
+    return {
+        'read': marks['write'] - marks['read'],
+        'write': marks['end'] - marks['write'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks building a '
+                                     'generated API reference.')
+    parser.add_argument('-p', '--pages', type=int, default=10,
+                        help='number of pages to generate')
+    parser.add_argument('-e', '--endpoints', type=int, default=50,
+                        help='number of endpoints per page')
+    parser.add_argument('-l', '--description-lines', type=int, default=30,
+                        help='lines of description before the fields of '
+                        'every endpoint')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='number of builds, the fastest one is reported')
+    parser.add_argument('-b', '--builder', default='sentryhtml')
+    args = parser.parse_args()
+
+    srcdir = tempfile.mkdtemp(prefix='sentry-bench-api-')
+    try:
+        generate(srcdir, args.pages, args.endpoints, args.description_lines)
+        results = [run(srcdir, args.builder) for x in xrange(args.repeat)]
+    finally:
+        shutil.rmtree(srcdir, ignore_errors=True)
+
+    print('%d endpoints, %d description lines each' % (
+        args.pages * args.endpoints, args.description_lines))
+    for phase in 'read', 'write':
+        print('%-6s %.3fs' % (phase + ':', min(x[phase] for x in results)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Answers questions about the doc graph of the last build (which docs are not
+published, who links to a doc and how a doc is reached from the index)
+without running Sphinx.  It reads the ``sentry-references.json`` file the
+extension saves in the doctree folder.
+"""
+import os
+import sys
+import json
+import argparse
+
+
+SIDECAR_FILENAME = 'sentry-references.json'
+
+
+def load_graph(doctreedir):
+    with open(os.path.join(doctreedir, SIDECAR_FILENAME)) as f:
+        data = json.load(f)
+    return data['docs'], data['references']
+
+
+def find_path_to_index(docname, references):
+    """Returns the shortest list of docs leading from the index to the given
+    doc through toctrees or `None` if it cannot be reached.
+    """
+    if docname == 'index':
+        return ['index']
+    # walk the backlinks until the index shows up
+    came_from = {docname: None}
+    to_process = [docname]
+    while to_process:
+        next_to_process = []
+        for current in to_process:
+            for backlink in references.get(current) or ():
+                if backlink in came_from:
+                    continue
+                came_from[backlink] = current
+                if backlink == 'index':
+                    rv = ['index']
+                    while rv[-1] != docname:
+                        rv.append(came_from[rv[-1]])
+                    return rv
+                next_to_process.append(backlink)
+        to_process = next_to_process
+
+
+def find_orphans(docs, references):
+    """Returns all docs that are not reachable from the index and are
+    therefore not published.
+    """
+    links = {}
+    for target, sources in references.iteritems():
+        for source in sources:
+            links.setdefault(source, []).append(target)
+    seen = set(['index'])
+    to_process = ['index']
+    while to_process:
+        for target in links.get(to_process.pop()) or ():
+            if target not in seen:
+                seen.add(target)
+                to_process.append(target)
+    return sorted(x for x in docs if x not in seen)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('-d', '--doctreedir', default='_build/doctrees',
+                        help='The doctree folder of the build.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('orphans', help='List docs that are not published '
+                          'because nothing leads to them from the index.')
+    backlinks_parser = subparsers.add_parser(
+        'backlinks', help='List the docs whose toctrees link to a doc.')
+    backlinks_parser.add_argument('docname')
+    path_parser = subparsers.add_parser(
+        'path', help='Show how a doc is reached from the index.')
+    path_parser.add_argument('docname')
+    args = parser.parse_args()
+
+    try:
+        docs, references = load_graph(args.doctreedir)
+    except IOError as e:
+        print >> sys.stderr, 'Could not load the doc graph (%s), build the ' \
+            'docs first.' % e
+        sys.exit(2)
+
+    if args.command == 'orphans':
+        for docname in find_orphans(docs, references):
+            print(docname)
+    elif args.command == 'backlinks':
+        for docname in sorted(references.get(args.docname) or ()):
+            print(docname)
+    elif args.command == 'path':
+        path = find_path_to_index(args.docname, references)
+        if path is None:
+            print >> sys.stderr, '%s is not reachable from the index' % \
+                args.docname
+            sys.exit(1)
+        print(' -> '.join(path))
+
+
+if __name__ == '__main__':
+    main()
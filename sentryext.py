@@ -4,7 +4,14 @@ import re
 import os
 import sys
 import json
+import gzip
+import errno
+import hashlib
+import tempfile
+import threading
+import traceback
 import posixpath
+import multiprocessing
 
 from docutils import nodes
 from docutils.io import StringOutput
@@ -13,11 +20,15 @@ from docutils.statemachine import ViewList
 from docutils.parsers.rst import directives
 from fnmatch import fnmatch
 from itertools import chain
+from collections import namedtuple
+from contextlib import contextmanager
 from urlparse import urljoin
+from Queue import Queue
 
 from sphinx import addnodes
 from sphinx.environment import url_re
 from sphinx.domains import Domain, ObjType
+from sphinx.errors import SphinxError, ConfigError
 from sphinx.directives import ObjectDescription
 from sphinx.util.osutil import relative_uri
 from sphinx.util.compat import Directive
@@ -35,6 +46,8 @@ _url_var_re = re.compile(r'\{(.*?)\}')
 _var_re = re.compile(r'###([a-zA-Z0-9_]+)###')
 
 
+OUTPUT_WRITER_THREADS = 4
+
 EXTERNAL_DOCS_URL = 'https://docs.getsentry.com/hosted/'
 API_BASE_URL = 'https://api.getsentry.com/'
 SUPPORT_LEVELS = {
@@ -59,21 +72,48 @@ SUPPORT_LEVELS = {
 }
 
 
-def find_config(path, root):
+def find_config_filename(path, root):
     while 1:
         if path is None or root is None:
             break
         if os.path.samefile(path, root):
             break
         if os.path.isfile(os.path.join(path, 'sentry-doc-config.json')):
-            with open(os.path.join(path, 'sentry-doc-config.json')) as f:
-                return json.load(f)
+            return os.path.join(path, 'sentry-doc-config.json')
         new_path = os.path.dirname(path)
         if new_path == path:
             break
         path = new_path
 
 
+def find_config(path, root):
+    filename = find_config_filename(path, root)
+    if filename is not None:
+        with open(filename) as f:
+            return json.load(f)
+
+
+def parse_wizard_snippet(base_path, snippet):
+    """Splits a wizard snippet into the docname and the optional section
+    name.
+    """
+    if '#' not in snippet:
+        snippet_path = snippet
+        section_name = None
+    else:
+        snippet_path, section_name = snippet.split('#', 1)
+    return posixpath.join(base_path, snippet_path), section_name
+
+
+def iter_wizard_snippets(data, base_path):
+    """Yields ``(docname, section_name)`` for all snippets used by the
+    wizards of a platform config.
+    """
+    for platform_data in data.get('platforms', {}).itervalues():
+        for snippet in platform_data.get('wizard') or ():
+            yield parse_wizard_snippet(base_path, snippet)
+
+
 def iter_url_parts(path):
     last = 0
     for match in _url_var_re.finditer(path):
@@ -87,110 +127,200 @@ def iter_url_parts(path):
         yield False, after
 
 
-def resolve_toctree(env, docname, builder, toctree, collapse=False):
-    def _toctree_add_classes(node):
-        for subnode in node.children:
-            if isinstance(subnode, (addnodes.compact_paragraph,
-                                    nodes.list_item,
-                                    nodes.bullet_list)):
-                _toctree_add_classes(subnode)
-            elif isinstance(subnode, nodes.reference):
-                # for <a>, identify which entries point to the current
-                # document and therefore may not be collapsed
-                if subnode['refuri'] == docname:
-                    list_item = subnode.parent.parent
-                    if not subnode['anchorname']:
-
-                        # give the whole branch a 'current' class
-                        # (useful for styling it differently)
-                        branchnode = subnode
-                        while branchnode:
-                            branchnode['classes'].append('current')
-                            branchnode = branchnode.parent
-                    # mark the list_item as "on current page"
-                    if subnode.parent.parent.get('iscurrent'):
-                        # but only if it's not already done
-                        return
-                    while subnode:
-                        subnode['iscurrent'] = True
-                        subnode = subnode.parent
-
-                    # Now mark all siblings as well and also give the
-                    # innermost expansion an extra class.
-                    list_item['classes'].append('active')
-                    for node in list_item.parent.children:
-                        node['classes'].append('relevant')
-
-    def _entries_from_toctree(toctreenode, parents, subtree=False):
-        refs = [(e[0], e[1]) for e in toctreenode['entries']]
-        entries = []
-        for (title, ref) in refs:
-            refdoc = None
-            if url_re.match(ref):
-                raise NotImplementedError('Not going to implement this (url)')
-            elif ref == 'env':
-                raise NotImplementedError('Not going to implement this (env)')
-            else:
-                if ref in parents:
-                    env.warn(ref, 'circular toctree references '
-                             'detected, ignoring: %s <- %s' %
-                             (ref, ' <- '.join(parents)))
-                    continue
-                refdoc = ref
-                toc = env.tocs[ref].deepcopy()
-                env.process_only_nodes(toc, builder, ref)
-                if title and toc.children and len(toc.children) == 1:
-                    child = toc.children[0]
-                    for refnode in child.traverse(nodes.reference):
-                        if refnode['refuri'] == ref and \
-                           not refnode['anchorname']:
-                            refnode.children = [nodes.Text(title)]
-            if not toc.children:
-                # empty toc means: no titles will show up in the toctree
-                env.warn_node(
-                    'toctree contains reference to document %r that '
-                    'doesn\'t have a title: no link will be generated'
-                    % ref, toctreenode)
-
-            # delete everything but the toplevel title(s)
-            # and toctrees
-            for toplevel in toc:
-                # nodes with length 1 don't have any children anyway
-                if len(toplevel) > 1:
-                    subtrees = toplevel.traverse(addnodes.toctree)
-                    toplevel[1][:] = subtrees
-
-            # resolve all sub-toctrees
-            for subtocnode in toc.traverse(addnodes.toctree):
-                i = subtocnode.parent.index(subtocnode) + 1
-                for item in _entries_from_toctree(subtocnode, [refdoc] +
-                                                  parents, subtree=True):
-                    subtocnode.parent.insert(i, item)
-                    i += 1
-                subtocnode.parent.remove(subtocnode)
-
-            entries.extend(toc.children)
-        if not subtree:
-            ret = nodes.bullet_list()
-            ret += entries
-            return [ret]
-        return entries
-
-    tocentries = _entries_from_toctree(toctree, [])
-    if not tocentries:
-        return None
+class _NavEntry(namedtuple('_NavEntry', 'refuri anchorname title children '
+                                         'docnames')):
+    """A single immutable entry of the navigation tree.  ``title`` holds the
+    title nodes of the entry, ``children`` is either `None` (the entry has
+    no sub list at all) or a tuple of more entries.  ``docnames`` is the
+    set of all docs linked from the entry or below it.
+    """
+    __slots__ = ()
 
-    newnode = addnodes.compact_paragraph('', '')
-    newnode.extend(tocentries)
-    newnode['toctree'] = True
 
-    _toctree_add_classes(newnode)
+def _get_nav_cache(builder):
+    # The navigation only depends on the toc trees in the environment and
+    # on the builder tags (for only nodes), so it can be shared by all
+    # pages the builder writes.
+    rv = getattr(builder, '_sentry_nav_cache', None)
+    if rv is None:
+        rv = builder._sentry_nav_cache = {}
+    return rv
+
+
+def _build_nav_entries(env, builder, ref, toctreenode, parents, cache):
+    toc = env.tocs[ref].deepcopy()
+    env.process_only_nodes(toc, builder, ref)
+    if not toc.children:
+        # empty toc means: no titles will show up in the toctree
+        env.warn_node(
+            'toctree contains reference to document %r that '
+            'doesn\'t have a title: no link will be generated'
+            % ref, toctreenode)
+
+    entries = []
+    complete = True
+    parents = [ref] + parents
+
+    # keep everything but the toplevel title(s) and toctrees
+    for toplevel in toc:
+        if isinstance(toplevel, addnodes.toctree):
+            sub_entries, sub_complete = _resolve_nav_entries(
+                env, builder, toplevel, parents, cache)
+            entries.extend(sub_entries)
+            complete = complete and sub_complete
+        elif isinstance(toplevel, nodes.list_item):
+            refnode = toplevel[0][0]
+            children = None
+            # nodes with length 1 don't have any children anyway
+            if len(toplevel) > 1:
+                children = []
+                for subtocnode in toplevel.traverse(addnodes.toctree):
+                    sub_entries, sub_complete = _resolve_nav_entries(
+                        env, builder, subtocnode, parents, cache)
+                    children.extend(sub_entries)
+                    complete = complete and sub_complete
+                children = tuple(children)
+            docnames = frozenset([refnode['refuri']]).union(
+                *[x.docnames for x in children or ()])
+            entries.append(_NavEntry(refnode['refuri'],
+                                     refnode['anchorname'],
+                                     tuple(refnode.children),
+                                     children, docnames))
+
+    return tuple(entries), len(toc.children) == 1, complete
+
+
+def _resolve_nav_entries(env, builder, toctreenode, parents, cache):
+    rv = []
+    complete = True
+    for title, ref in toctreenode['entries']:
+        if url_re.match(ref):
+            raise NotImplementedError('Not going to implement this (url)')
+        elif ref == 'env':
+            raise NotImplementedError('Not going to implement this (env)')
+        if ref in parents:
+            env.warn(ref, 'circular toctree references '
+                     'detected, ignoring: %s <- %s' %
+                     (ref, ' <- '.join(parents)))
+            complete = False
+            continue
 
-    for refnode in newnode.traverse(nodes.reference):
-        if not url_re.match(refnode['refuri']):
-            refnode.parent.parent['classes'].append('ref-' + refnode['refuri'])
-            refnode['refuri'] = builder.get_relative_uri(
-                docname, refnode['refuri']) + refnode['anchorname']
+        cached = cache.get(ref)
+        if cached is not None:
+            entries, single = cached
+        else:
+            entries, single, ref_complete = _build_nav_entries(
+                env, builder, ref, toctreenode, parents, cache)
+            # Trees that were cut short because of a circular reference
+            # depend on the path they were reached by, so they are not
+            # remembered.
+            if ref_complete:
+                cache[ref] = entries, single
+            else:
+                complete = False
+
+        if title and single:
+            entries = tuple(
+                x._replace(title=(nodes.Text(title),))
+                if x.refuri == ref and not x.anchorname else x
+                for x in entries)
+        rv.extend(entries)
+    return rv, complete
+
+
+def _make_nav_nodes(entries, docname, builder, collapse=False, maxdepth=0,
+                    depth=1):
+    """Creates fresh nodes for some navigation entries and applies the
+    classes and relative URIs for the page `docname` to them.  Returns the
+    list items together with the "current" and "iscurrent" flags of the
+    branch.
+
+    Sub lists below `maxdepth` are left out and with `collapse` only the
+    ones on the path to the current page are kept.
+    """
+    items = []
+    branch_current = branch_iscurrent = has_active = False
+
+    for entry in entries:
+        reference = nodes.reference('', '', internal=True,
+                                    refuri=entry.refuri,
+                                    anchorname=entry.anchorname,
+                                    *[x.deepcopy() for x in entry.title])
+        para = addnodes.compact_paragraph('', '', reference)
+        item = nodes.list_item('', para)
+
+        # for <a>, identify which entries point to the current
+        # document and therefore may not be collapsed
+        if entry.refuri == docname:
+            marked = (reference, para, item)
+            current = not entry.anchorname
+            iscurrent = has_active = True
+        else:
+            marked = (item,)
+            current = iscurrent = False
+
+        expand = entry.children is not None and \
+            (maxdepth <= 0 or depth < maxdepth) and \
+            (not collapse or docname in entry.docnames)
+        if not expand:
+            # a pruned branch still counts as current if the page is
+            # somewhere inside of it
+            if docname != entry.refuri and docname in entry.docnames:
+                current = iscurrent = True
+        else:
+            sub_items, sub_current, sub_iscurrent = _make_nav_nodes(
+                entry.children, docname, builder, collapse, maxdepth,
+                depth + 1)
+            sublist = nodes.bullet_list('', *sub_items)
+            if sub_current:
+                sublist['classes'].append('current')
+            if sub_iscurrent:
+                sublist['iscurrent'] = True
+            item += sublist
+            current = current or sub_current
+            iscurrent = iscurrent or sub_iscurrent
+
+        # give the whole branch a 'current' class (useful for styling
+        # it differently) and mark it as "on current page"
+        for node in marked:
+            if current:
+                node['classes'].append('current')
+            if iscurrent:
+                node['iscurrent'] = True
+        if entry.refuri == docname:
+            # give the innermost expansion an extra class
+            item['classes'].append('active')
+
+        reference['refuri'] = builder.get_relative_uri(
+            docname, entry.refuri) + entry.anchorname
+        items.append(item)
+        branch_current = branch_current or current
+        branch_iscurrent = branch_iscurrent or iscurrent
+
+    for item, entry in zip(items, entries):
+        # Now mark all siblings as well
+        if has_active:
+            item['classes'].append('relevant')
+        item['classes'].append('ref-' + entry.refuri)
+
+    return items, branch_current, branch_iscurrent
+
+
+def resolve_toctree(env, docname, builder, toctree, collapse=False,
+                    maxdepth=0):
+    entries = _resolve_nav_entries(env, builder, toctree, [],
+                                   _get_nav_cache(builder))[0]
+    items, current, iscurrent = _make_nav_nodes(entries, docname, builder,
+                                                collapse, maxdepth)
+
+    ret = nodes.bullet_list('', *items)
+    newnode = addnodes.compact_paragraph('', '', ret)
+    newnode['toctree'] = True
+    for node in ret, newnode:
+        if current:
+            node['classes'].append('current')
+        if iscurrent:
+            node['iscurrent'] = True
 
     return newnode
 
@@ -217,9 +347,13 @@ def html_page_context(app, pagename, templatename, context, doctree):
     # toc_parts = get_rendered_toctree(app.builder, pagename)
     # context['full_toc'] = toc_parts['main']
 
-    def build_toc(split_toc=None):
-        return get_rendered_toctree(app.builder, pagename, collapse=False,
-                                    split_toc=split_toc)
+    def build_toc(split_toc=None, collapse=None, maxdepth=None):
+        if collapse is None:
+            collapse = app.config.sentry_toc_collapse
+        if maxdepth is None:
+            maxdepth = app.config.sentry_toc_maxdepth
+        return get_rendered_toctree(app.builder, pagename, collapse=collapse,
+                                    split_toc=split_toc, maxdepth=maxdepth)
     context['build_toc'] = build_toc
 
     def page_link(path, name):
@@ -285,8 +419,10 @@ def extract_toc(fulltoc, selectors):
     return newnode
 
 
-def get_rendered_toctree(builder, docname, collapse=True, split_toc=None):
-    fulltoc = build_full_toctree(builder, docname, collapse=collapse)
+def get_rendered_toctree(builder, docname, collapse=True, split_toc=None,
+                         maxdepth=0):
+    fulltoc = build_full_toctree(builder, docname, collapse=collapse,
+                                 maxdepth=maxdepth)
 
     rv = {}
 
@@ -301,13 +437,19 @@ def get_rendered_toctree(builder, docname, collapse=True, split_toc=None):
     return rv
 
 
-def build_full_toctree(builder, docname, collapse=True):
+def build_full_toctree(builder, docname, collapse=True, maxdepth=0):
     env = builder.env
-    doctree = env.get_doctree(env.config.master_doc)
+    cache = _get_nav_cache(builder)
+    # the toctrees of the master document are kept under the `None` key
+    master_toctrees = cache.get(None)
+    if master_toctrees is None:
+        doctree = env.get_doctree(env.config.master_doc)
+        master_toctrees = cache[None] = \
+            list(doctree.traverse(addnodes.toctree))
     toctrees = []
-    for toctreenode in doctree.traverse(addnodes.toctree):
+    for toctreenode in master_toctrees:
         toctrees.append(resolve_toctree(env, docname, builder, toctreenode,
-                                        collapse=collapse))
+                                        collapse=collapse, maxdepth=maxdepth))
     if not toctrees:
         return None
     result = toctrees[0]
@@ -440,8 +582,10 @@ class ApiScenarioDirective(Directive):
 
     def get_scenario_info(self):
         ident = self.arguments[0].encode('ascii', 'replace')
-        with open(find_cached_api_json(self.state.document.settings.env,
-                                       'scenarios/%s.json' % ident)) as f:
+        env = self.state.document.settings.env
+        filename = find_cached_api_json(env, 'scenarios/%s.json' % ident)
+        env.note_dependency(filename)
+        with open(filename) as f:
             return json.load(f)
 
     def iter_body(self, data, is_json=True):
@@ -544,7 +688,14 @@ class SentryDomain(Domain):
 
 
 def preprocess_source(app, docname, source):
-    cfg = find_config(app.env.doc2path(docname), app.builder.srcdir)
+    cfg_filename = find_config_filename(app.env.doc2path(docname),
+                                        app.builder.srcdir)
+    cfg = None
+    if cfg_filename is not None:
+        # variables come from the config, so changing it outdates the doc
+        app.env.note_dependency(cfg_filename)
+        with open(cfg_filename) as f:
+            cfg = json.load(f)
     source_lines = source[0].splitlines()
 
     def _find_block(indent, lineno):
@@ -605,11 +756,31 @@ def preprocess_source(app, docname, source):
     source[:] = [u'\n'.join(result)]
 
 
+def get_gzip_level(config):
+    """Returns the configured gzip level or `None` if compression is
+    disabled.
+    """
+    level = config.sentry_gzip_level
+    if level is None:
+        return None
+    # values given with -D on the command line arrive as strings
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        level = None
+    if level is None or not 1 <= level <= 9:
+        raise ConfigError('sentry_gzip_level must be a number from 1 to 9, '
+                          'not %r' % config.sentry_gzip_level)
+    return level
+
+
 def builder_inited(app):
     # XXX: this currently means thigns only stay referenced after a
     # deletion of a link after a clean build :(
     if not hasattr(app.env, 'sentry_referenced_docs'):
         app.env.sentry_referenced_docs = {}
+    # fail before anything is written rather than at the very end
+    get_gzip_level(app.config)
 
 
 def track_references_and_orphan_doc(app, doctree):
@@ -661,8 +832,140 @@ def is_referenced(docname, references):
     return False
 
 
+# mkstemp only gives the owner access to the file but the output should end
+# up with the same permissions that a regular open() would give it.
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+@contextmanager
+def atomic_open(filename):
+    """Opens a temporary file next to `filename` for writing which replaces
+    `filename` once the block is left without an error.  That way readers
+    never see a half written file.
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename),
+        prefix='.' + os.path.basename(filename) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.chmod(tmp_filename, 0o666 & ~_umask)
+        os.rename(tmp_filename, filename)
+    except:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+
+
+class OutputWriteError(SphinxError):
+    category = 'Output write error'
+
+
+class OutputWriter(object):
+    """Writes output files from a bounded pool of background threads so
+    that the build does not have to wait for the disk.  All writes go
+    through :func:`atomic_open`.
+    """
+
+    def __init__(self, threads=OUTPUT_WRITER_THREADS):
+        self.threads = threads
+        self._queue = None
+        self._workers = []
+        self._errors = []
+        self._created_dirs = set()
+        self._dir_lock = threading.Lock()
+
+    def ensure_dir(self, path):
+        with self._dir_lock:
+            if path in self._created_dirs:
+                return
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            self._created_dirs.add(path)
+
+    def _work(self):
+        while 1:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                filename, write_func = item
+                try:
+                    self.ensure_dir(os.path.dirname(filename))
+                    with atomic_open(filename) as f:
+                        write_func(f)
+                except Exception:
+                    self._errors.append((filename, traceback.format_exc()))
+            finally:
+                self._queue.task_done()
+
+    def submit(self, filename, write_func):
+        """Schedules `write_func` to be called with a file object that ends
+        up as `filename`.  Blocks if too many writes are pending.
+        """
+        if not self._workers:
+            # bounded so that pending output cannot pile up in memory
+            self._queue = Queue(self.threads * 8)
+            for x in xrange(self.threads):
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        self._queue.put((filename, write_func))
+
+    def write_json(self, filename, data):
+        def _write(f):
+            json.dump(data, f)
+            f.write('\n')
+        self.submit(filename, _write)
+
+    def drain(self):
+        """Waits for all scheduled writes to finish and stops the threads.
+        Raises an :exc:`OutputWriteError` if any of the writes failed.
+        """
+        for worker in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._created_dirs.clear()
+
+        errors, self._errors = self._errors, []
+        if errors:
+            raise OutputWriteError('Failed to write %d file(s):\n%s' % (
+                len(errors),
+                '\n'.join('%s\n%s' % x for x in errors),
+            ))
+
+
+def _gzip_file(args):
+    filename, level, old_hash = args
+    with open(filename, 'rb') as f:
+        data = f.read()
+    new_hash = hashlib.sha1(data).hexdigest()
+    if new_hash != old_hash or not os.path.isfile(filename + '.gz'):
+        with atomic_open(filename + '.gz') as f:
+            # no mtime in the header so that the same input always gives
+            # the same output
+            gz = gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                               compresslevel=level, mtime=0)
+            try:
+                gz.write(data)
+            finally:
+                gz.close()
+    return filename, new_hash
+
+
 class SphinxBuilderMixin(object):
     build_wizard_fragment = False
+    # only render the platforms for the wizards, no HTML pages
+    wizard_only = False
 
     @property
     def add_permalinks(self):
@@ -680,84 +983,157 @@ class SphinxBuilderMixin(object):
         return super(SphinxBuilderMixin, self).get_relative_uri(
             from_, to, typ)
 
+    def get_outdated_docs(self):
+        if self.wizard_only:
+            return 'wizard platforms'
+        return super(SphinxBuilderMixin, self).get_outdated_docs()
+
+    def write(self, *args, **kwargs):
+        if self.wizard_only:
+            # no pages are written but the wizards still need the writer
+            self.prepare_writing(set())
+            return
+        return super(SphinxBuilderMixin, self).write(*args, **kwargs)
+
+    def prepare_writing(self, docnames):
+        super(SphinxBuilderMixin, self).prepare_writing(docnames)
+        # sections used by the wizards are rendered for them while their
+        # page is written so finish() does not have to load them again
+        self._wizard_sections = {}
+        self._wizard_fragments = {}
+        for docname, section_name in self.__iter_wizard_snippets():
+            self._wizard_sections.setdefault(docname, set()).add(section_name)
+
     def write_doc(self, docname, doctree):
         original_field_limit = self.docsettings.field_name_limit
         try:
             self.docsettings.field_name_limit = 120
             if is_referenced(docname, self.app.env.sentry_referenced_docs):
-                return super(SphinxBuilderMixin, self).write_doc(docname, doctree)
+                super(SphinxBuilderMixin, self).write_doc(docname, doctree)
             else:
                 self.app.info('skipping because unreferenced')
         finally:
             self.docsettings.field_name_limit = original_field_limit
 
+        # Pages written by parallel workers cannot hand their fragments
+        # back, finish() loads and renders those sections itself.
+        if docname in self._wizard_sections and not self.parallel_ok:
+            self.__capture_wizard_fragments(docname, doctree)
+
     def __iter_platform_files(self):
         for dirpath, dirnames, filenames in os.walk(self.srcdir,
                                                     followlinks=True):
             dirnames[:] = [x for x in dirnames if x[:1] not in '_.']
             for filename in filenames:
                 if filename == 'sentry-doc-config.json':
-                    full_path = os.path.join(self.srcdir, dirpath)
-                    base_path = full_path[len(self.srcdir):].strip('/\\') \
-                        .replace(os.path.sep, '/')
-                    yield os.path.join(full_path, filename), base_path
+                    base_path = os.path.relpath(dirpath, self.srcdir)
+                    if base_path == os.curdir:
+                        base_path = ''
+                    yield os.path.join(dirpath, filename), \
+                        base_path.replace(os.path.sep, '/')
+
+    def __iter_wizard_snippets(self):
+        for filename, base_path in self.__iter_platform_files():
+            with open(filename) as f:
+                for item in iter_wizard_snippets(json.load(f), base_path):
+                    yield item
+
+    def get_wizard_docnames(self):
+        """Returns the names of all docs that the wizards are made of."""
+        return set(docname for docname, section_name
+                   in self.__iter_wizard_snippets())
+
+    def __render_wizard_node(self, docname, doctree, node):
+        original_header_level = self.docsettings.initial_header_level
+        # bump initial header level to two
+        self.docsettings.initial_header_level = 2
+        # Embed pygments colors as inline styles
+        original_args = self.highlighter.formatter_args
+        self.highlighter.formatter_args = original_args.copy()
+        self.highlighter.formatter_args['noclasses'] = True
+        try:
+            sub_doc = document(self.docsettings,
+                               doctree.reporter)
+            sub_doc += node
+            destination = StringOutput(encoding='utf-8')
+            self.current_docname = docname
+            self.docwriter.write(sub_doc, destination)
+            self.docwriter.assemble_parts()
+            return self.docwriter.parts['fragment']
+        finally:
+            self.highlighter.formatter_args = original_args
+            self.docsettings.initial_header_level = original_header_level
+
+    def __find_wizard_sections(self, doctree, section_name):
+        if section_name is None:
+            # the first section is the whole document
+            for sect in doctree.traverse(section):
+                return [sect]
+            return []
+        return [x for x in doctree.traverse(section)
+                if section_name in x['ids']]
+
+    def __capture_wizard_fragments(self, docname, doctree):
+        # The sections are still rendered a second time as the wizards need
+        # other settings than the page (see __render_wizard_node).  What
+        # this saves is loading and resolving the doctree again in finish().
+        #
+        # The page doctree was resolved with relative links, the wizards
+        # need them absolute.  Relative links are relative to the page, so
+        # joining them with its absolute URL gives the same result as
+        # resolving the doctree for the wizard in the first place.
+        self.build_wizard_fragment = True
+        try:
+            base_uri = self.get_target_uri(docname)
+            for section_name in self._wizard_sections[docname]:
+                fragments = []
+                for sect in self.__find_wizard_sections(doctree,
+                                                        section_name):
+                    sect = sect.deepcopy()
+                    for refnode in sect.traverse(nodes.reference):
+                        if refnode.get('internal') and 'refuri' in refnode:
+                            refnode['refuri'] = urljoin(base_uri,
+                                                        refnode['refuri'])
+                    fragments.append(self.__render_wizard_node(
+                        docname, doctree, sect))
+                self._wizard_fragments[docname, section_name] = fragments
+        finally:
+            self.build_wizard_fragment = False
 
     def __build_wizard_section(self, base_path, snippets):
         trees = {}
         rv = []
 
-        def _build_node(node):
-            original_header_level = self.docsettings.initial_header_level
-            # bump initial header level to two
-            self.docsettings.initial_header_level = 2
-            # indicate that we're building for the wizard fragements.
-            # This changes url generation and more.
-            # Embed pygments colors as inline styles
-            original_args = self.highlighter.formatter_args
-            self.highlighter.formatter_args = original_args.copy()
-            self.highlighter.formatter_args['noclasses'] = True
-            try:
-                sub_doc = document(self.docsettings,
-                                   doctree.reporter)
-                sub_doc += node
-                destination = StringOutput(encoding='utf-8')
-                self.current_docname = docname
-                self.docwriter.write(sub_doc, destination)
-                self.docwriter.assemble_parts()
-                rv.append(self.docwriter.parts['fragment'])
-            finally:
-                self.highlighter.formatter_args = original_args
-                self.docsettings.initial_header_level = original_header_level
-
+        # indicate that we're building for the wizard fragements.
+        # This changes url generation and more.
         self.build_wizard_fragment = True
         try:
             for snippet in snippets:
-                if '#' not in snippet:
-                    snippet_path = snippet
-                    section_name = None
-                else:
-                    snippet_path, section_name = snippet.split('#', 1)
-                docname = posixpath.join(base_path, snippet_path)
+                docname, section_name = parse_wizard_snippet(base_path,
+                                                             snippet)
+                # sections captured while their page was written
+                fragments = self._wizard_fragments.get((docname,
+                                                        section_name))
+                if fragments is not None:
+                    rv.extend(fragments)
+                    continue
+
                 if docname in trees:
                     doctree = trees.get(docname)
                 else:
                     doctree = self.env.get_and_resolve_doctree(docname, self)
                     trees[docname] = doctree
 
-                if section_name is None:
-                    _build_node(next(iter(doctree.traverse(section))))
-                else:
-                    for sect in doctree.traverse(section):
-                        if section_name in sect['ids']:
-                            _build_node(sect)
+                for sect in self.__find_wizard_sections(doctree,
+                                                        section_name):
+                    rv.append(self.__render_wizard_node(docname, doctree,
+                                                        sect))
         finally:
             self.build_wizard_fragment = False
 
         return u'\n\n'.join(rv)
 
     def __process_platform(self, data, base_path):
-        rv = {}
-
         for uid, platform_data in data.get('platforms', {}).iteritems():
             try:
                 body = self.__build_wizard_section(base_path,
@@ -770,7 +1146,7 @@ class SphinxBuilderMixin(object):
             if doc_link is not None:
                 doc_link = urljoin(EXTERNAL_DOCS_URL,
                                    posixpath.join(base_path, doc_link))
-            rv[uid] = {
+            yield uid, {
                 'name': platform_data.get('name') or uid.title(),
                 'type': platform_data.get('type') or 'generic',
                 'doc_link': doc_link,
@@ -778,9 +1154,7 @@ class SphinxBuilderMixin(object):
                 'body': body,
             }
 
-        return rv
-
-    def __process_platform_index(self, platforms):
+    def __process_platform_index(self, platforms, offsets=None):
         tree = {}
 
         for uid, platform_data in platforms.iteritems():
@@ -793,48 +1167,239 @@ class SphinxBuilderMixin(object):
             else:
                 base = uid
                 local_name = '_self'
-            tree.setdefault(base, {})[local_name] = {
-                'details': uid.replace('.', '/') + '.json',
+            entry = tree.setdefault(base, {})[local_name] = {
+                'details': platform_data['details'],
                 'name': platform_data['name'],
                 'type': platform_data['type'],
                 'doc_link': platform_data['doc_link'],
             }
+            if 'support_level' in platform_data:
+                entry['support_level'] = platform_data['support_level']
+            if offsets is not None:
+                entry['offset'], entry['length'] = offsets[uid]
 
         return tree
 
-    def __write_platforms(self):
-        platforms = {}
+    def __get_platform_filename(self, uid):
+        return os.path.join(self.outdir, '_platforms', *uid.split('.')) \
+            + '.json'
+
+    def __write_platform_body(self, uid, platform_data):
+        """Hands a platform to the output writer and returns the name of
+        the file holding its body, relative to ``_platforms``."""
+        writer = self.app.sentry_output_writer
+        if not self.config.sentry_platforms_content_addressed:
+            writer.write_json(self.__get_platform_filename(uid),
+                              platform_data)
+            return uid.replace('.', '/') + '.json'
+
+        # Bodies are named after their content so platforms with the same
+        # wizard share one file and an unchanged body keeps its URL.  Files
+        # of earlier builds are never rewritten or removed as clients may
+        # still hold on to them.
+        body = platform_data['body']
+        details = '_bodies/%s.json' % \
+            hashlib.sha1(body.encode('utf-8')).hexdigest()[:20]
+        filename = os.path.join(self.outdir, '_platforms',
+                                *details.split('/'))
+        if details not in self._written_bodies and \
+           not os.path.isfile(filename):
+            writer.write_json(filename, {'body': body})
+        self._written_bodies.add(details)
+        return details
+
+    def __get_platform_cache_key(self, data, base_path):
+        # The platforms of a config only need to be rendered again if the
+        # config changed or one of the docs its wizards are made of was
+        # read again since.
+        docnames = sorted(set(docname for docname, section_name
+                              in iter_wizard_snippets(data, base_path)))
+        return data, [(x, self.env.all_docs.get(x)) for x in docnames]
+
+    def __iter_platforms(self):
+        """Renders the platforms of all configs and yields ``(uid,
+        platform_data, details)`` for each of them where ``details`` is the
+        file the body was written to.  Every platform is handed to the
+        output writer as soon as it is rendered.
+        """
+        # In watch mode the platforms of unchanged configs are read back
+        # from the output of the last build instead of being rendered again.
+        cache = getattr(self, '_sentry_platform_cache', None)
+        if cache is None:
+            cache = self._sentry_platform_cache = {}
+        platform_dir = os.path.join(self.outdir, '_platforms')
+        self._written_bodies = set()
+
+        def _get_filename(details):
+            return os.path.join(platform_dir, *details.split('/'))
+
+        configs = []
+        owners = {}
         for filename, base_path in self.__iter_platform_files():
             with open(filename) as f:
                 data = json.load(f)
-                platforms.update(self.__process_platform(data, base_path))
-
-        index = self.__process_platform_index(platforms)
+            configs.append((filename, base_path, data))
+            for uid in data.get('platforms', ()):
+                owners[uid] = filename
+
+        for filename, base_path, data in configs:
+            # As with a single platforms dict the last config defining a
+            # platform wins, the others must not race it in the writer.
+            platforms = {}
+            for uid, platform_data in data.get('platforms', {}).iteritems():
+                if owners[uid] == filename:
+                    platforms[uid] = platform_data
+                else:
+                    print >> sys.stderr, 'Platform "%s" is defined in ' \
+                        'more than one config (using %s)' % (uid,
+                                                             owners[uid])
+            data = dict(data, platforms=platforms)
+            key = self.__get_platform_cache_key(data, base_path)
+            cached = cache.get(filename)
+            if cached is not None and cached[0] == key and \
+               all(os.path.isfile(_get_filename(details))
+                   for uid, meta, details in cached[1]):
+                for uid, meta, details in cached[1]:
+                    with open(_get_filename(details)) as f:
+                        body = json.load(f)['body']
+                    self._written_bodies.add(details)
+                    yield uid, dict(meta, body=body), details
+                continue
 
-        fn = os.path.join(self.outdir, '_platforms', '_index.json')
+            entries = []
+            for uid, platform_data in self.__process_platform(data,
+                                                              base_path):
+                details = self.__write_platform_body(uid, platform_data)
+                meta = dict((k, v) for k, v in platform_data.iteritems()
+                            if k != 'body')
+                entries.append((uid, meta, details))
+                yield uid, platform_data, details
+            cache[filename] = key, entries
+
+    def __replace_bundle(self, platform_dir, partial_fn, bundle, index):
+        # The bundle is named after its contents so the offsets in the
+        # index always belong to the bundle it points to, no matter when a
+        # reader fetches either.  The bundle of the previous index is kept
+        # for readers that loaded that index just before it was replaced.
+        index_fn = os.path.join(platform_dir, '_bundle_index.json')
         try:
-            os.makedirs(os.path.dirname(fn))
-        except OSError:
-            pass
-
-        with open(fn, 'w') as f:
-            json.dump({'platforms': index}, f)
+            with open(index_fn) as f:
+                previous = json.load(f).get('bundle')
+        except (IOError, ValueError):
+            previous = None
+
+        os.rename(partial_fn, os.path.join(platform_dir, bundle))
+        with atomic_open(index_fn) as f:
+            json.dump({'bundle': bundle, 'platforms': index}, f)
             f.write('\n')
 
-        for uid, platform_data in platforms.iteritems():
-            fn = os.path.join(self.outdir, '_platforms', *uid.split('.')) \
-                + '.json'
-            try:
-                os.makedirs(os.path.dirname(fn))
-            except OSError:
-                pass
-            with open(fn, 'w') as f:
-                json.dump(platform_data, f)
-                f.write('\n')
+        for filename in os.listdir(platform_dir):
+            if filename.startswith('_bundle-') and \
+               filename.endswith('.jsonl') and \
+               filename not in (bundle, previous):
+                os.remove(os.path.join(platform_dir, filename))
+
+    def __write_platforms(self):
+        # Only the small metadata needed for the index is kept around, the
+        # bodies are gone once they were written.
+        platforms = {}
+
+        def _add_platform(uid, platform_data, details):
+            platforms[uid] = {
+                'details': details,
+                'name': platform_data['name'],
+                'type': platform_data['type'],
+                'doc_link': platform_data['doc_link'],
+            }
+            if self.config.sentry_platforms_content_addressed:
+                platforms[uid]['support_level'] = \
+                    platform_data['support_level']
+
+        writer = self.app.sentry_output_writer
+        platform_dir = os.path.join(self.outdir, '_platforms')
+        writer.ensure_dir(platform_dir)
+
+        if not self.config.sentry_platforms_bundle:
+            for uid, platform_data, details in self.__iter_platforms():
+                _add_platform(uid, platform_data, details)
+        else:
+            # Every platform goes on its own line so the bundle can be read
+            # as a whole as well as one platform at a time with a range
+            # request.
+            offsets = {}
+            h = hashlib.sha1()
+            partial_fn = os.path.join(platform_dir, '.bundle.jsonl')
+            with atomic_open(partial_fn) as f:
+                for uid, platform_data, details in self.__iter_platforms():
+                    _add_platform(uid, platform_data, details)
+                    line = json.dumps(platform_data) + '\n'
+                    offsets[uid] = f.tell(), len(line) - 1
+                    f.write(line)
+                    h.update(line)
+            self.__replace_bundle(platform_dir, partial_fn,
+                                  '_bundle-%s.jsonl' % h.hexdigest()[:20],
+                                  self.__process_platform_index(platforms,
+                                                                offsets))
+
+        writer.write_json(os.path.join(platform_dir, '_index.json'),
+                          {'platforms': self.__process_platform_index(
+                              platforms)})
 
     def finish(self):
-        super(SphinxBuilderMixin, self).finish()
+        if not self.wizard_only:
+            super(SphinxBuilderMixin, self).finish()
         self.__write_platforms()
+        self._wizard_fragments = {}
+
+    def __iter_compressible_files(self):
+        for dirpath, dirnames, filenames in os.walk(self.outdir):
+            dirnames[:] = [x for x in dirnames if x[:1] != '.']
+            in_platforms = os.path.relpath(dirpath, self.outdir) \
+                .split(os.path.sep)[0] == '_platforms'
+            for filename in filenames:
+                if filename[:1] == '.':
+                    continue
+                if filename.endswith('.html') or \
+                   (in_platforms and filename.endswith('.json')):
+                    yield os.path.join(dirpath, filename)
+
+    def compress_output(self, level):
+        """Writes precompressed ``.gz`` files next to the HTML pages and
+        the platform files.  Files whose contents did not change since the
+        last run are not compressed again.
+        """
+        hash_fn = os.path.join(self.doctreedir, 'sentry-gzip-hashes.json')
+        try:
+            with open(hash_fn) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            cached = {}
+        if cached.get('level') != level:
+            cached = {}
+        old_hashes = cached.get('files') or {}
+
+        tasks = []
+        for filename in self.__iter_compressible_files():
+            rel_fn = os.path.relpath(filename, self.outdir)
+            tasks.append((filename, level, old_hashes.get(rel_fn)))
+
+        processes = min(multiprocessing.cpu_count(), len(tasks))
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                results = pool.map(_gzip_file, tasks, chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_gzip_file, tasks)
+
+        with atomic_open(hash_fn) as f:
+            json.dump({
+                'level': level,
+                'files': dict((os.path.relpath(filename, self.outdir), x)
+                              for filename, x in results),
+            }, f)
 
 
 class SentryStandaloneHTMLBuilder(SphinxBuilderMixin, StandaloneHTMLBuilder):
@@ -845,6 +1410,25 @@ class SentryDirectoryHTMLBuilder(SphinxBuilderMixin, DirectoryHTMLBuilder):
     name = 'sentrydirhtml'
 
 
+class SentryWizardBuilder(SphinxBuilderMixin, StandaloneHTMLBuilder):
+    """Only reads the docs the wizards need and writes the platforms
+    without any HTML pages.  Works best with the doctree folder of a
+    previous full build so that references to other docs resolve.
+    """
+    name = 'sentrywizard'
+    wizard_only = True
+    search = False
+
+
+class SentryWizardDirectoryBuilder(SphinxBuilderMixin, DirectoryHTMLBuilder):
+    """Like ``sentrywizard`` but links the docs the way ``sentrydirhtml``
+    does.
+    """
+    name = 'sentrywizarddirhtml'
+    wizard_only = True
+    search = False
+
+
 def collect_sitemap_link(app, pagename, templatename, context, doctree):
     """
     As each page is built, collect page names for the sitemap
@@ -874,11 +1458,92 @@ def build_sitemap(app, exception):
     root = ET.Element("urlset")
     root.set("xmlns", "http://www.sitemaps.org/schemas/sitemap/0.9")
 
+    seen = set()
     for link in app.sitemap_links:
+        # in watch mode pages show up again each time they are rebuilt
+        if link in seen:
+            continue
+        seen.add(link)
         url = ET.SubElement(root, "url")
         ET.SubElement(url, "loc").text = '{}/{}'.format(base_url.rstrip('/'), link)
 
-    ET.ElementTree(root).write(filename)
+    app.sentry_output_writer.submit(filename, ET.ElementTree(root).write)
+
+
+def flush_output(app, exception):
+    """
+    Waits for the output files that are still being written in the
+    background.
+    """
+    try:
+        app.sentry_output_writer.drain()
+    except OutputWriteError:
+        # don't hide the error the build failed with
+        if exception is None:
+            raise
+
+
+def finish_output(app, exception):
+    """
+    Writes the sitemap, waits for all output that is still being written
+    in the background and then precompresses it.  Sphinx does not call the
+    listeners of an event in the order they were connected, so these steps
+    share a single listener.
+    """
+    build_sitemap(app, exception)
+    flush_output(app, exception)
+    compress_output(app, exception)
+
+
+def compress_output(app, exception):
+    """
+    Precompresses the output of the sentry builders if enabled.
+    """
+    level = get_gzip_level(app.config)
+    if exception is not None or level is None:
+        return
+    if isinstance(app.builder, SphinxBuilderMixin):
+        app.builder.compress_output(level)
+
+
+def filter_wizard_docs(app, env, docnames):
+    """
+    Limits reading to the docs of the wizards for the wizard builder.
+    """
+    if getattr(app.builder, 'wizard_only', False):
+        wizard_docnames = app.builder.get_wizard_docnames()
+        docnames[:] = [x for x in docnames if x in wizard_docnames]
+
+        # The wizards link to labels and docs that only an earlier full
+        # build put into the environment.
+        missing = [x for x in env.found_docs
+                   if x not in wizard_docnames and x not in env.all_docs]
+        if missing:
+            app.warn('%d docs were not read by an earlier full build (e.g. '
+                     '%s), links from the wizards to them stay unresolved.  '
+                     'Reuse the doctree folder of a full build.'
+                     % (len(missing), sorted(missing)[0]))
+
+
+def write_reference_sidecar(app, env):
+    """
+    Saves the doc references next to the pickled environment in a format
+    that loads quickly for ``doc-graph.py``.
+    """
+    filename = os.path.join(app.doctreedir, 'sentry-references.json')
+    with atomic_open(filename) as f:
+        json.dump({
+            'docs': sorted(env.found_docs),
+            'references': dict((target, sorted(docs)) for target, docs
+                               in env.sentry_referenced_docs.iteritems()),
+        }, f)
+
+
+def reset_nav_cache(app, env):
+    """
+    Forgets the navigation of the last build after the environment changed.
+    """
+    app.builder._sentry_nav_cache = None
 
 
 def setup(app):
@@ -891,15 +1556,27 @@ def setup(app):
     app.connect('html-page-context', html_page_context)
     app.connect('source-read', preprocess_source)
     app.connect('doctree-read', track_references_and_orphan_doc)
+    app.connect('env-before-read-docs', filter_wizard_docs)
+    app.connect('env-updated', reset_nav_cache)
+    app.connect('env-updated', write_reference_sidecar)
     app.add_builder(SentryStandaloneHTMLBuilder)
     app.add_builder(SentryDirectoryHTMLBuilder)
+    app.add_builder(SentryWizardBuilder)
+    app.add_builder(SentryWizardDirectoryBuilder)
     app.add_config_value('sentry_doc_variant', None, 'env')
+    app.add_config_value('sentry_toc_collapse', False, 'html')
+    app.add_config_value('sentry_toc_maxdepth', 0, 'html')
     app.connect('env-purge-doc', purge_info)
     app.connect('env-merge-info', merge_info)
 
     app.connect('html-page-context', collect_sitemap_link)
-    app.connect('build-finished', build_sitemap)
+    app.connect('build-finished', finish_output)
     app.sitemap_links = []
+    app.sentry_output_writer = OutputWriter()
+
+    app.add_config_value('sentry_gzip_level', None, 'html')
+    app.add_config_value('sentry_platforms_bundle', False, 'html')
+    app.add_config_value('sentry_platforms_content_addressed', False, 'html')
 
     return {'version': '1.0', 'parallel_read_safe': True}
 
@@ -917,3 +1594,297 @@ def activate():
     globs['primary_domain'] = 'std'
     globs['exclude_patterns'] = list(globs.get('exclude_patterns')
                                      or ()) + ['_sentryext']
+
+
+def snapshot_sources(srcdir, ignore=()):
+    """Returns the modification times of everything in the source folder
+    that can affect the build.
+    """
+    ignore = set(os.path.realpath(x) for x in ignore)
+    rv = {}
+    for dirpath, dirnames, filenames in os.walk(srcdir, followlinks=True):
+        dirnames[:] = [x for x in dirnames if x[:1] != '.' and
+                       os.path.realpath(os.path.join(dirpath, x))
+                       not in ignore]
+        in_apicache = '_apicache' in dirpath.split(os.path.sep)
+        for filename in filenames:
+            if filename.endswith('.rst') or in_apicache or \
+               filename == 'sentry-doc-config.json':
+                fn = os.path.join(dirpath, filename)
+                try:
+                    rv[fn] = os.stat(fn).st_mtime
+                except OSError:
+                    pass
+    return rv
+
+
+def serve_output(outdir, port):
+    """Serves the output folder on the given port from a background
+    thread.
+    """
+    import BaseHTTPServer
+    import SimpleHTTPServer
+
+    class OutputRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+
+        def translate_path(self, path):
+            rv = SimpleHTTPServer.SimpleHTTPRequestHandler \
+                .translate_path(self, path)
+            return os.path.join(outdir, os.path.relpath(rv, os.getcwd()))
+
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', port),
+                                       OutputRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print('Serving %s on http://127.0.0.1:%d/' % (outdir, port))
+    return server
+
+
+def watch(srcdir, outdir, buildername='sentryhtml', doctreedir=None,
+          confoverrides=None, interval=1.0, port=None):
+    """Builds the docs and rebuilds them whenever sources, platform configs
+    or API scenarios change.  The Sphinx application and its environment
+    stay loaded between builds so only outdated pages are written again.
+    """
+    import time
+    from sphinx.application import Sphinx
+
+    # sphinx-build does the same, relative paths end up in docnames and
+    # dependencies otherwise
+    srcdir = os.path.abspath(srcdir)
+    outdir = os.path.abspath(outdir)
+    if doctreedir is None:
+        doctreedir = os.path.join(outdir, '.doctrees')
+    doctreedir = os.path.abspath(doctreedir)
+    app = Sphinx(srcdir, srcdir, outdir, doctreedir, buildername,
+                 confoverrides or {})
+    if port is not None:
+        serve_output(app.outdir, port)
+
+    snapshot = None
+    while 1:
+        new_snapshot = snapshot_sources(srcdir, ignore=(outdir, doctreedir))
+        if new_snapshot != snapshot:
+            snapshot = new_snapshot
+            try:
+                app.build()
+            except Exception:
+                traceback.print_exc()
+                print('Build failed, waiting for changes')
+        time.sleep(interval)
+
+
+def fingerprint_tree(root, ignore=()):
+    """Returns a checksum over the names, sizes and modification times of
+    all files below `root`.
+    """
+    ignore = set(os.path.realpath(x) for x in ignore)
+    h = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+        dirnames[:] = sorted(x for x in dirnames if x[:1] != '.' and
+                             os.path.realpath(os.path.join(dirpath, x))
+                             not in ignore)
+        for filename in sorted(filenames):
+            fn = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            h.update('%s\0%d\0%r\0' % (os.path.relpath(fn, root),
+                                         st.st_size, st.st_mtime))
+    return h.hexdigest()
+
+
+def _build_federated_root(args):
+    srcdir, outdir, doctreedir, buildername, confoverrides = args
+    from sphinx.application import Sphinx
+
+    # everything that influences the output goes into the fingerprint
+    fingerprint = '%s\n%s\n%s\n' % (
+        fingerprint_tree(srcdir, ignore=(outdir, doctreedir)),
+        buildername,
+        json.dumps(confoverrides, sort_keys=True),
+    )
+    fingerprint_fn = os.path.join(doctreedir, 'sentry-fingerprint')
+    try:
+        with open(fingerprint_fn) as f:
+            if f.read() == fingerprint and os.path.isdir(outdir):
+                return srcdir, True, 0
+    except IOError:
+        pass
+    # the output is not known to be complete until the build succeeded
+    try:
+        os.remove(fingerprint_fn)
+    except OSError:
+        pass
+
+    # a broken repository must not take down the builds of the others
+    try:
+        app = Sphinx(srcdir, srcdir, outdir, doctreedir, buildername,
+                     dict(confoverrides), status=None)
+        app.build()
+    except Exception:
+        traceback.print_exc()
+        return srcdir, False, 1
+    if app.statuscode == 0:
+        with atomic_open(fingerprint_fn) as f:
+            f.write(fingerprint)
+    return srcdir, False, app.statuscode
+
+
+def merge_federated_output(outdir, suboutdirs):
+    """Merges the platforms and sitemaps of the federated builds into
+    `outdir`.
+    """
+    import shutil
+    import xml.etree.ElementTree as ET
+
+    index = {}
+    links = []
+    seen = set()
+    for suboutdir in suboutdirs:
+        platform_dir = os.path.join(suboutdir, '_platforms')
+        try:
+            with open(os.path.join(platform_dir, '_index.json')) as f:
+                sub_index = json.load(f)['platforms']
+        except IOError:
+            sub_index = {}
+        for base, entries in sub_index.iteritems():
+            for local_name in entries:
+                if local_name in index.get(base, ()):
+                    print >> sys.stderr, 'Platform "%s.%s" is defined by ' \
+                        'more than one build (using %s)' % (base, local_name,
+                                                            suboutdir)
+            index.setdefault(base, {}).update(entries)
+
+        for dirpath, dirnames, filenames in os.walk(platform_dir):
+            target_dir = os.path.join(outdir, '_platforms',
+                                      os.path.relpath(dirpath, platform_dir))
+            for filename in filenames:
+                if filename[:1] in '_.':
+                    continue
+                if not os.path.isdir(target_dir):
+                    os.makedirs(target_dir)
+                shutil.copy2(os.path.join(dirpath, filename),
+                             os.path.join(target_dir, filename))
+
+        try:
+            tree = ET.parse(os.path.join(suboutdir, 'sitemap.xml'))
+        except IOError:
+            continue
+        for loc in tree.iter('{http://www.sitemaps.org/schemas/sitemap/0.9}loc'):
+            if loc.text not in seen:
+                seen.add(loc.text)
+                links.append(loc.text)
+
+    if index:
+        if not os.path.isdir(os.path.join(outdir, '_platforms')):
+            os.makedirs(os.path.join(outdir, '_platforms'))
+        with atomic_open(os.path.join(outdir, '_platforms',
+                                      '_index.json')) as f:
+            json.dump({'platforms': index}, f)
+            f.write('\n')
+
+    if links:
+        root = ET.Element("urlset")
+        root.set("xmlns", "http://www.sitemaps.org/schemas/sitemap/0.9")
+        for link in links:
+            url = ET.SubElement(root, "url")
+            ET.SubElement(url, "loc").text = link
+        with atomic_open(os.path.join(outdir, 'sitemap.xml')) as f:
+            ET.ElementTree(root).write(f)
+
+
+def build_federated(srcdirs, outdir, buildername='sentryhtml',
+                    confoverrides=None, jobs=None):
+    """Builds the docs in all given source folders concurrently, each into
+    its own folder below `outdir`, and merges their platforms and sitemaps.
+    The environment of every build is kept in ``outdir/.doctrees`` and
+    roots that did not change since their last successful build are
+    skipped entirely.  Returns `True` if all builds succeeded.
+    """
+    tasks = []
+    suboutdirs = []
+    for srcdir in srcdirs:
+        srcdir = os.path.abspath(srcdir)
+        name = os.path.basename(srcdir)
+        # most repositories keep their docs in a docs folder
+        if name == 'docs':
+            name = os.path.basename(os.path.dirname(srcdir))
+        suboutdir = os.path.join(outdir, name)
+        if suboutdir in suboutdirs:
+            raise ValueError('More than one source folder named "%s"' % name)
+        suboutdirs.append(suboutdir)
+        tasks.append((srcdir, suboutdir,
+                      os.path.join(outdir, '.doctrees', name),
+                      buildername, confoverrides or {}))
+
+    # A fresh process per build as Sphinx and the conf.py files keep global
+    # state around.
+    pool = multiprocessing.Pool(jobs, maxtasksperchild=1)
+    try:
+        results = pool.map(_build_federated_root, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    success = True
+    merged = []
+    for suboutdir, (srcdir, skipped, statuscode) in zip(suboutdirs, results):
+        if skipped:
+            print('%s: unchanged, skipped' % srcdir)
+        elif statuscode != 0:
+            # whatever is left in its folder is from an earlier run
+            print('%s: build failed, not merged' % srcdir)
+            success = False
+            continue
+        else:
+            print('%s: built' % srcdir)
+        merged.append(suboutdir)
+
+    merge_federated_output(outdir, merged)
+    return success
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(prog='sentryext')
+    subparsers = parser.add_subparsers()
+
+    watch_parser = subparsers.add_parser(
+        'watch', help='Rebuild the docs whenever they change.')
+    watch_parser.add_argument('srcdir')
+    watch_parser.add_argument('outdir')
+    watch_parser.add_argument('-b', '--builder', default='sentryhtml')
+    watch_parser.add_argument('-d', '--doctreedir', default=None)
+    watch_parser.add_argument('-i', '--interval', type=float, default=1.0,
+                              help='Seconds between checks for changes.')
+    watch_parser.add_argument('-p', '--port', type=int, default=None,
+                              help='Serve the output on this port.')
+    watch_parser.set_defaults(func=lambda args: watch(
+        args.srcdir, args.outdir, args.builder, args.doctreedir,
+        interval=args.interval, port=args.port))
+
+    federate_parser = subparsers.add_parser(
+        'federate', help='Build the docs of many repositories at once.')
+    federate_parser.add_argument('outdir')
+    federate_parser.add_argument('srcdirs', nargs='+')
+    federate_parser.add_argument('-b', '--builder', default='sentryhtml')
+    federate_parser.add_argument('-j', '--jobs', type=int, default=None,
+                                 help='Number of concurrent builds.')
+    federate_parser.add_argument('-D', dest='overrides', action='append',
+                                 default=[], metavar='setting=value',
+                                 help='Override a setting of all builds.')
+    federate_parser.set_defaults(func=lambda args: sys.exit(
+        0 if build_federated(
+            args.srcdirs, args.outdir, args.builder,
+            dict(x.split('=', 1) for x in args.overrides),
+            args.jobs) else 1))
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -7,13 +7,26 @@ some of the more frustrating issues for federated doc support.
 import os
 import re
 import sys
+import json
 import errno
+import hashlib
+import posixpath
+import argparse
 import subprocess
+import multiprocessing
 
 
 _ref_target_re = re.compile(r'^\.\.\s+_([^:]+):')
 _doc_ref_re = re.compile(r':doc:`([^`]+)`')
 _explicit_target_re = re.compile(r'.+?\s+\<(.*?)\>')
+_ref_role_re = re.compile(r':ref:`([^`]+)`')
+# labels may be indented, e.g. within sentry:edition blocks
+_label_re = re.compile(r'^\s*\.\.\s+_([^:]+):\s*$')
+
+CACHE_FILENAME = 'verify-docs-cache.json'
+INDEX_FILENAME = 'verify-docs-index.json'
+CACHE_VERSION = 2
+INDEX_VERSION = 2
 
 
 def find_git_root():
@@ -49,8 +62,7 @@ def find_mistakes(iterable, valid_ref_prefixes=()):
                               ', '.join('"%s"' % x for x in valid_ref_prefixes))
 
         # Disallow absolute doc links except /index
-        match = _doc_ref_re.match(line)
-        if match is not None:
+        for match in _doc_ref_re.finditer(line):
             target = get_ref_target(match.group(1))
             if target != '/index' and target[:1] == '/':
                 yield mistake('Absolute doc link found. This seems like a '
@@ -76,36 +88,375 @@ def warn(msg):
     print >> sys.stderr, 'WARNING: %s' % msg
 
 
+def find_git_dir():
+    return subprocess.Popen(['git', 'rev-parse', '--git-dir'],
+                            stdout=subprocess.PIPE).communicate()[0].strip()
+
+
+def get_blob_sha(data):
+    """Calculates the SHA git would give a blob with the given contents."""
+    return hashlib.sha1('blob %d\0%s' % (len(data), data)).hexdigest()
+
+
+def find_all_docs():
+    """Yields ``(filename, sha)`` for all rst files known to git.  The sha
+    is `None` for files that were modified in the working tree.
+    """
+    modified = set(subprocess.Popen(
+        ['git', 'ls-files', '-m', '-z', '--', '*.rst'],
+        stdout=subprocess.PIPE).communicate()[0].split('\0'))
+    stdout = subprocess.Popen(['git', 'ls-files', '-s', '-z', '--', '*.rst'],
+                              stdout=subprocess.PIPE).communicate()[0]
+    seen = set()
+    for item in stdout.split('\0'):
+        if not item:
+            continue
+        info, filename = item.split('\t', 1)
+        # unmerged files show up once per stage
+        if filename in seen:
+            continue
+        seen.add(filename)
+        sha = info.split()[1]
+        yield filename, (sha if filename not in modified else None)
+
+
+def load_cache(filename, valid_ref_prefixes):
+    try:
+        with open(filename) as f:
+            cache = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    # the results depend on the checks and the prefixes so they cannot be
+    # reused if either changed
+    if cache.get('version') != CACHE_VERSION or \
+       tuple(cache.get('prefixes') or ()) != valid_ref_prefixes:
+        return {}
+    return cache.get('results') or {}
+
+
+def save_cache(filename, valid_ref_prefixes, results):
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump({
+            'version': CACHE_VERSION,
+            'prefixes': valid_ref_prefixes,
+            'results': results,
+        }, f, separators=(',', ':'))
+    os.rename(tmp_filename, filename)
+
+
+_worker_ref_prefixes = ()
+
+
+def _init_worker(valid_ref_prefixes):
+    global _worker_ref_prefixes
+    _worker_ref_prefixes = valid_ref_prefixes
+
+
+def _check_file(filename):
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return filename, None, []
+    mistakes = [(lineno, line.rstrip('\r\n'), msg) for lineno, line, msg
+                in find_mistakes(data.splitlines(True),
+                                 _worker_ref_prefixes)]
+    return filename, get_blob_sha(data), mistakes
+
+
+def check_all_docs(valid_ref_prefixes, cache_filename=None, jobs=None):
+    """Checks all rst files in the repository with a process pool and
+    yields ``(filename, mistakes)``.  Results for unchanged files are
+    taken from the cache.
+    """
+    cache = {}
+    if cache_filename is not None:
+        cache = load_cache(cache_filename, valid_ref_prefixes)
+
+    new_cache = {}
+    to_check = []
+    for filename, sha in find_all_docs():
+        if sha is not None and sha in cache:
+            new_cache[sha] = cache[sha]
+            yield filename, cache[sha]
+        else:
+            to_check.append(filename)
+
+    if to_check:
+        pool = multiprocessing.Pool(jobs, _init_worker, (valid_ref_prefixes,))
+        try:
+            for filename, sha, mistakes in pool.imap_unordered(
+                    _check_file, to_check, chunksize=8):
+                if sha is not None:
+                    new_cache[sha] = mistakes
+                yield filename, mistakes
+        finally:
+            pool.close()
+            pool.join()
+
+    if cache_filename is not None:
+        save_cache(cache_filename, valid_ref_prefixes, new_cache)
+
+
+class GitBlobReader(object):
+    """Reads blobs through a single long running ``git cat-file --batch``
+    process instead of spawning git for every file.
+    """
+
+    def __init__(self):
+        self.proc = subprocess.Popen(['git', 'cat-file', '--batch'],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def read(self, sha):
+        self.proc.stdin.write(sha + '\n')
+        self.proc.stdin.flush()
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise KeyError(sha)
+        data = self.proc.stdout.read(int(header[2]))
+        # every blob is followed by a newline
+        self.proc.stdout.read(1)
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def extract_targets(iterable):
+    """Extracts the labels a file defines as well as all references and doc
+    links in it.  References and doc links are returned as lists of
+    ``(lineno, target)``.
+    """
+    labels = []
+    refs = []
+    docs = []
+    for idx, line in enumerate(iterable):
+        # targets followed by an URL are hyperlinks and not labels
+        match = _label_re.match(line)
+        if match is not None:
+            labels.append(match.group(1).lower())
+        for match in _ref_role_re.finditer(line):
+            refs.append((idx + 1, get_ref_target(match.group(1)).lower()))
+        for match in _doc_ref_re.finditer(line):
+            docs.append((idx + 1, get_ref_target(match.group(1))))
+    return labels, refs, docs
+
+
+def find_staged_blobs():
+    """Yields ``(filename, sha)`` for all rst files in the git index."""
+    stdout = subprocess.Popen(['git', 'ls-files', '-s', '-z', '--', '*.rst'],
+                              stdout=subprocess.PIPE).communicate()[0]
+    for item in stdout.split('\0'):
+        if item:
+            info, filename = item.split('\t', 1)
+            yield filename, info.split()[1]
+
+
+def update_ref_index(filename):
+    """Loads the reference index from `filename` and brings it up to date
+    with the git index.  Only blobs that changed since the last run are
+    read, all of them through one ``git cat-file`` process.
+    """
+    try:
+        with open(filename) as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        index = None
+    if index is None or index.get('version') != INDEX_VERSION:
+        index = {'version': INDEX_VERSION, 'files': {}}
+
+    old_files = index['files']
+    new_files = {}
+    reader = None
+    try:
+        for doc_filename, sha in find_staged_blobs():
+            entry = old_files.get(doc_filename)
+            if entry is None or entry[0] != sha:
+                if reader is None:
+                    reader = GitBlobReader()
+                lines = iter(reader.read(sha).splitlines(True))
+                entry = [sha] + list(extract_targets(lines))
+            new_files[doc_filename] = entry
+    finally:
+        if reader is not None:
+            reader.close()
+
+    changed = new_files != old_files
+    index['files'] = new_files
+    if changed:
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        os.rename(tmp_filename, filename)
+    return index
+
+
+def find_unresolved_refs(index, filenames, valid_ref_prefixes=()):
+    """Yields ``(filename, mistakes)`` for the references and doc links in
+    the given files that do not resolve to anything in the index.  Only
+    references to labels with one of the valid prefixes and doc links that
+    stay within the source dir are checked as all others belong to other
+    repositories of the federated docs.
+    """
+    srcdirs = {}
+
+    def get_srcdir(filename):
+        # the source dir is the closest folder with a conf.py
+        path = os.path.dirname(filename)
+        if path not in srcdirs:
+            if os.path.isfile(os.path.join(path, 'conf.py')) or not path:
+                srcdirs[path] = path
+            else:
+                srcdirs[path] = get_srcdir(path)
+        return srcdirs[path]
+
+    def get_docname(filename):
+        srcdir = get_srcdir(filename)
+        return srcdir, os.path.splitext(filename[len(srcdir):]) \
+            [0].lstrip('/')
+
+    labels = set()
+    docnames = set()
+    for filename, (sha, file_labels, refs, docs) in index['files'].items():
+        srcdir, docname = get_docname(filename)
+        docnames.add((srcdir, docname))
+        labels.update((srcdir, label) for label in file_labels)
+
+    for filename in filenames:
+        entry = index['files'].get(filename)
+        if entry is None:
+            continue
+        srcdir, docname = get_docname(filename)
+        mistakes = []
+        for lineno, target in entry[2]:
+            if valid_ref_prefixes and \
+               not target.startswith(valid_ref_prefixes):
+                continue
+            if (srcdir, target) not in labels:
+                mistakes.append((lineno, ':ref:`%s`' % target,
+                                 'Reference to unknown label "%s"'
+                                 % target))
+        for lineno, target in entry[3]:
+            if target[:1] == '/':
+                resolved = target[1:]
+            else:
+                resolved = posixpath.normpath(posixpath.join(
+                    posixpath.dirname(docname), target))
+                # links out of the source dir go to other repositories of
+                # the federated docs
+                if resolved.split('/', 1)[0] == '..':
+                    continue
+            if (srcdir, resolved) not in docnames:
+                mistakes.append((lineno, ':doc:`%s`' % target,
+                                 'Link to unknown document "%s"' % target))
+        if mistakes:
+            yield filename, mistakes
+
+
 def find_modified_docs():
-    stdout = subprocess.Popen(['git', 'diff-index', '--cached',
-                               '--name-only', 'HEAD'],
+    """Yields ``(filename, sha)`` for all rst files staged for commit.  The
+    sha is the one of the staged blob.
+    """
+    stdout = subprocess.Popen(['git', 'diff-index', '--cached', '-z',
+                               'HEAD'],
                               stdout=subprocess.PIPE).communicate()[0]
-    for line in stdout.splitlines():
-        if line.endswith('.rst'):
-            yield line
+    items = stdout.split('\0')
+    for info, filename in zip(items[::2], items[1::2]):
+        # :old_mode new_mode old_sha new_sha status
+        info = info.split()
+        if info[4] != 'D' and filename.endswith('.rst'):
+            yield filename, info[3]
+
+
+def check_modified_docs(valid_ref_prefixes=None):
+    reader = None
+    try:
+        for filename, sha in find_modified_docs():
+            if reader is None:
+                if valid_ref_prefixes is None:
+                    valid_ref_prefixes = get_valid_ref_prefixes()
+                reader = GitBlobReader()
+            lines = iter(reader.read(sha).splitlines(True))
+            yield filename, list(find_mistakes(lines, valid_ref_prefixes))
+    finally:
+        if reader is not None:
+            reader.close()
 
 
 def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--all', action='store_true',
+                        help='Check all rst files in the repository instead '
+                        'of the ones staged for commit.')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='Number of processes to check files with '
+                        '(defaults to the number of CPUs).')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Do not use or update the result cache.')
+    parser.add_argument('--format', choices=('text', 'json'), default='text',
+                        help='Output format for the found mistakes.')
+    parser.add_argument('--check-refs', action='store_true',
+                        help='Also report references and doc links that do '
+                        'not resolve, based on an index of all rst files in '
+                        'the git index.')
+    args = parser.parse_args()
+
+    # looking up the prefixes talks to the remote so it is only done once
+    # and, when checking staged files, only if there are any
     valid_ref_prefixes = None
-    warnings = 0
-    for filename in find_modified_docs():
-        if valid_ref_prefixes is None:
-            valid_ref_prefixes = get_valid_ref_prefixes()
-        try:
-            with open(filename) as f:
-                mistakes = find_mistakes(f, valid_ref_prefixes)
-                for lineno, line, msg in mistakes:
-                    warn('%s (%s:%s)' % (
-                        msg,
-                        filename,
-                        lineno,
-                    ))
-                    warnings += 1
-        except IOError as e:
-            if e.errno != errno.ENOENT:
-                raise
-
-    if warnings > 0:
+    if args.all or args.check_refs:
+        valid_ref_prefixes = get_valid_ref_prefixes()
+
+    if args.all:
+        cache_filename = None
+        if not args.no_cache:
+            cache_filename = os.path.join(find_git_dir(), CACHE_FILENAME)
+        results = check_all_docs(valid_ref_prefixes, cache_filename,
+                                 args.jobs)
+    else:
+        results = check_modified_docs(valid_ref_prefixes)
+
+    if args.check_refs:
+        results = list(results)
+        index = update_ref_index(os.path.join(find_git_dir(),
+                                              INDEX_FILENAME))
+        results.extend(find_unresolved_refs(
+            index, [filename for filename, mistakes in results],
+            valid_ref_prefixes))
+
+    warnings = []
+    for filename, mistakes in results:
+        for lineno, line, msg in mistakes:
+            if args.format == 'text':
+                warn('%s (%s:%s)' % (
+                    msg,
+                    filename,
+                    lineno,
+                ))
+            warnings.append({
+                'filename': filename,
+                'lineno': lineno,
+                'line': line.rstrip('\r\n'),
+                'message': msg,
+            })
+
+    if args.format == 'json':
+        warnings.sort(key=lambda x: (x['filename'], x['lineno']))
+        json.dump(warnings, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if warnings:
         sys.exit(1)
 
 